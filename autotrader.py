@@ -16,13 +16,16 @@
 #     License along with Ready Trader Go.  If not, see
 #     <https://www.gnu.org/licenses/>.
 import asyncio
+import atexit
+import bisect
 import itertools
 import math
-import csv # DELETEME
+import os
 
-from typing import List
+from typing import List, Optional, Set, Tuple
 
 from ready_trader_go import BaseAutoTrader, Instrument, Lifespan, MAXIMUM_ASK, MINIMUM_BID, Side
+from ready_trader_go.messages import HEADER
 
 
 # LOT_SIZE = 10
@@ -31,26 +34,42 @@ TICK_SIZE_IN_CENTS = 100
 MIN_BID_NEAREST_TICK = (MINIMUM_BID + TICK_SIZE_IN_CENTS) // TICK_SIZE_IN_CENTS * TICK_SIZE_IN_CENTS
 MAX_ASK_NEAREST_TICK = MAXIMUM_ASK // TICK_SIZE_IN_CENTS * TICK_SIZE_IN_CENTS
 LIQUIDITY_MAGNITUDE = 8
-LIQUIDITY_THRESHOLDS = [t * 10**LIQUIDITY_MAGNITUDE for t in (0.25, 0.5, 0.75)]
-POSITION_THRESHOLDS = [-90, -50, -25, 25, 50, 90]
+LIQUIDITY_THRESHOLDS = tuple(t * 10**LIQUIDITY_MAGNITUDE for t in (0.25, 0.5, 0.75))
+POSITION_THRESHOLDS = (-90, -50, -25, 25, 50, 90)
+# Extra price adjustment for a bid at the extreme position adjustments
+EMERGENCY_ADJUSTMENTS = {-4: 3 * TICK_SIZE_IN_CENTS, 4: -3 * TICK_SIZE_IN_CENTS}
+MAX_LIQUIDITY = 2 * 10 ** 7
 UNHEDGED_LIMIT = 50
+INPUTS_ROW = "%d,%d,%s,%s,%s,%d,%d,%s,%d,%d\n" # DELETEME
+FLUSH_INTERVAL = 1.0 # DELETEME
+
+# Module-level aliases save an attribute lookup per call on the tick path
+_log = math.log
+_fabs = math.fabs
+_bisect_left = bisect.bisect_left
+_bisect_right = bisect.bisect_right
+
+# The lot size is floor(20 * sqrt((100 - position) / 200) * sqrt(liquidity / MAX_LIQUIDITY)),
+# which reaches k once liquidity >= MAX_LIQUIDITY * k**2 / (2 * (100 - position)).
+# These thresholds are indexed by position + POSITION_LIMIT; the exchange
+# disconnects us outside the limit, so the table covers every position.
+_LOT_THRESHOLDS = tuple(
+    tuple(MAX_LIQUIDITY * k * k / (2 * (100 - position)) for k in range(1, math.isqrt(2 * (100 - position)) + 1))
+    for position in range(-POSITION_LIMIT, POSITION_LIMIT + 1))
 
 class Order:
-    def __init__(self, id, price, lot, start):
+    __slots__ = ("id", "price", "lot", "start", "filled")
+
+    def __init__(self, id: int, price: int, lot: int, start: float):
         self.id = id
         self.price = price
         self.lot = lot
         self.start = start
-    
-    def copy(self):
-        return Order(self.id, self.price, self.lot, self.start)
+        self.filled = 0
 
-    def __repr__(self):
+    def __repr__(self) -> str:
         return f"Order(id={self.id}, price={self.price}, lot={self.lot} start={self.start})"
 
-    def __str__(self):
-        return self.__repr__()
-
 class AutoTrader(BaseAutoTrader):
     """Example Auto-trader.
 
@@ -61,54 +80,105 @@ class AutoTrader(BaseAutoTrader):
     more lots than it has bought) then it increases its bid and ask prices.
     """
 
+    __slots__ = ("next_order_id", "bid_base", "bid_shifted", "ask_base", "ask_shifted", "new_bid_lot",
+                 "new_bid_price", "bid_liquidity", "new_ask_lot", "new_ask_price", "ask_liquidity", "etf_position",
+                 "futures_position", "position", "unhedged_start", "unhedged_interval", "market_state", "last_book",
+                 "etf_bids", "etf_asks", "futures_asks", "futures_bids", "cancelled_ids", "is_hedging", "outbox",
+                 "debug", "inputs_file", "log_file", "flush_timer")
+
     def __init__(self, loop: asyncio.AbstractEventLoop, team_name: str, secret: str):
         """Initialise a new instance of the AutoTrader class."""
-        print("Initialising AutoTrader")
         super().__init__(loop, team_name, secret)
-        self.order_ids = itertools.count(1)
+        self.logger.info("initialising auto-trader")
+        self.next_order_id = itertools.count(1).__next__
         self.bid_base = self.bid_shifted = self.ask_base = self.ask_shifted = None
         self.new_bid_lot = self.new_bid_price = self.bid_liquidity = \
             self.new_ask_lot = self.new_ask_price = self.ask_liquidity = \
                 self.etf_position = self.futures_position = self.position = \
                       self.unhedged_start = self.unhedged_interval = 0
         self.market_state = 0 # -1 = short, 0 = neutral, 1 = long
-        self.etf_bids, self.etf_asks, self.futures_asks, self.futures_bids = (dict() for _ in range(4))
+        self.last_book = None
+        self.etf_bids, self.etf_asks = set(), set()
+        self.futures_asks, self.futures_bids = set(), set()
+        self.cancelled_ids = set()
         self.is_hedging = False
+        self.outbox = None
+        self.debug = os.environ.get("RTG_DEBUG") == "1" # DELETEME
+
+        self.inputs_file = self.log_file = self.flush_timer = None
+        if self.debug:
+            # Both files stay open for the lifetime of the trader so that the
+            # per-tick writes go through a buffer rather than an open/close.
+            self.inputs_file = open("output/inputs.csv", "w", buffering=1 << 16) # DELETEME
+            self.inputs_file.write("position,hedged,avg_price,market_state,bid_liquidity,bid_spread,bid_lot,"
+                                   "ask_liquidity,ask_spread,ask_lot\n")
+
+            self.log_file = open('output/logs.txt', 'w', buffering=1 << 16) # DELETEME
+            self.flush_timer = self.event_loop.call_later(FLUSH_INTERVAL, self.flush_files) # DELETEME
+            # The exchange may stop the trader without dropping the connection
+            atexit.register(self.close_files)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        """Flush and close the output files when the connection is lost."""
+        if self.debug:
+            self.close_files()
+        super().connection_lost(exc)
+
+    def flush_files(self) -> None: # DELETEME
+        """Flush the output files so they can be followed during a run."""
+        self.inputs_file.flush()
+        self.log_file.flush()
+        self.flush_timer = self.event_loop.call_later(FLUSH_INTERVAL, self.flush_files)
+
+    def close_files(self) -> None: # DELETEME
+        """Flush and close the output files."""
+        self.flush_timer.cancel()
+        self.inputs_file.close()
+        self.log_file.close()
+
+    def send_message(self, typ: int, data: bytes, length: int) -> None:
+        """Send a message, or queue it if a batch of messages is open."""
+        if self.outbox is None:
+            super().send_message(typ, data, length)
+        else:
+            self.outbox += HEADER.pack(length, typ)
+            self.outbox += data
 
-        with open("output/inputs.csv", "w", newline='') as f: # DELETEME
-            writer = csv.writer(f)
-            writer.writerow(['position', 'hedged', 'avg_price', 'market_state', 'bid_liquidity', 'bid_spread', 'bid_lot', 'ask_liquidity', 'ask_spread', 'ask_lot'])
-        
-        with open('output/logs.txt' , 'w') as f: # DELETEME
-            f.write("")
-
+    def send_batch(self) -> None:
+        """Send every message queued since the batch was opened in one write."""
+        outbox, self.outbox = self.outbox, None
+        if outbox:
+            self._connection_transport.write(outbox)
 
-    def print_status(self): # DELETEME
+    def print_status(self) -> None: # DELETEME
         """Log the current status of the autotrader."""
-        with open('output/logs.txt', 'a') as f:
-            f.write(f"Asks: {self.etf_asks}, Ask base: {self.ask_base}, Ask shifted: {self.ask_shifted}\n")
-            f.write(f"Bids: {self.etf_bids}, Bid base: {self.bid_base}, Bid shifted: {self.bid_shifted}\n")
+        if not self.debug:
+            return
+        self.log_file.write(f"Asks: {self.etf_asks}, Ask base: {self.ask_base}, Ask shifted: {self.ask_shifted}\n")
+        self.log_file.write(f"Bids: {self.etf_bids}, Bid base: {self.bid_base}, Bid shifted: {self.bid_shifted}\n")
 
 
-    def log(self, text): # DELETEME
-        """Log text to a file."""
-        with open('output/logs.txt', 'a') as f:
-            f.write(text + "\n")
+    def log(self, text: str, *args) -> None: # DELETEME
+        """Log text to a file when debugging.
+
+        Any arguments are %-formatted into the text, which only happens if
+        the line is actually written.
+        """
+        if self.debug:
+            self.log_file.write((text % args if args else text) + "\n")
 
 
-    def define_market_state(self):
+    def define_market_state(self) -> float:
         """Defines the current state of the market.
         
         Uses the relative liquidities of the bid and ask orders to determine
         whether the market is long, short, or neutral on a scale of -2 to 2.
         """
-        if self.bid_liquidity == 0 or self.ask_liquidity == 0:
+        bid_liquidity, ask_liquidity = self.bid_liquidity, self.ask_liquidity
+        if not bid_liquidity or not ask_liquidity:
             return 0
 
-        if self.bid_liquidity > self.ask_liquidity:
-            return self.bid_liquidity/self.ask_liquidity - 1
-        else:
-            return -(self.ask_liquidity/self.bid_liquidity) + 1
+        return bid_liquidity/ask_liquidity - 1 if bid_liquidity > ask_liquidity else 1 - ask_liquidity/bid_liquidity
 
     def on_error_message(self, client_order_id: int, error_message: bytes) -> None:
         """Called when the exchange detects an error.
@@ -128,107 +198,122 @@ class AutoTrader(BaseAutoTrader):
         prices are reported along with the volume available at each of those
         price levels.
         """
-        self.logger.info("received order book for instrument %d with sequence number %d", instrument,
-                         sequence_number)
-
-        if instrument == Instrument.ETF:
-            pass
-
-        if instrument == Instrument.FUTURE:
-            # Keeping track of unhedged lots
-            if abs(self.position) > 10 and not self.is_hedging:
-                self.unhedged_interval = self.event_loop.time() - self.unhedged_start
-            else:
-                self.unhedged_start = self.event_loop.time()
-                self.unhedged_interval = 0
+        self.logger.debug("received order book for instrument %d with sequence number %d", instrument,
+                          sequence_number)
+
+        # Quotes are only recalculated on futures book updates
+        if instrument != Instrument.FUTURE:
+            return
+
+        # Keeping track of unhedged lots
+        now = self.event_loop.time()
+        if abs(self.position) > 10 and not self.is_hedging:
+            self.unhedged_interval = now - self.unhedged_start
+        else:
+            self.unhedged_start = now
+            self.unhedged_interval = 0
 
-            # Hedging in emergencies
-            if self.unhedged_interval > UNHEDGED_LIMIT and not self.is_hedging:
+        # Hedging in emergencies
+        if self.unhedged_interval > UNHEDGED_LIMIT and not self.is_hedging:
+            self.outbox = bytearray()
+            try:
                 self.emergency_hedge()
-                self.unhedged_start = self.event_loop.time()
+                self.unhedged_start = now
                 self.unhedged_interval = 0
-                self.reset_orders(self.etf_bids, 0, 0, 0)
-                self.reset_orders(self.etf_asks, 0, 0, 0)
-                return
-
-            # Calculating inputs
-            avg_price = (ask_prices[0] + bid_prices[0]) / 2
-            self.calc_lot_sizes(
-                avg_price, ask_prices, ask_volumes, bid_prices, bid_volumes)
-            self.market_state = self.define_market_state()
-
-            self.new_bid_price, bid_spread = self.calc_price(
-                avg_price, bid_prices, self.bid_liquidity)
-            self.new_ask_price, ask_spread = self.calc_price(
-                avg_price, ask_prices, self.ask_liquidity, True)
-
-            # Reset orders
+                self.reset_orders(self.etf_bids, 0, 0)
+                self.reset_orders(self.etf_asks, 0, 0)
+            finally:
+                self.send_batch()
+            return
+
+        # Calculating inputs
+        avg_price = (ask_prices[0] + bid_prices[0]) / 2
+        self.calc_lot_sizes(
+            avg_price, ask_prices, ask_volumes, bid_prices, bid_volumes)
+        self.market_state = self.define_market_state()
+
+        self.new_bid_price, bid_spread = self.calc_price(
+            avg_price, bid_prices, self.bid_liquidity)
+        self.new_ask_price, ask_spread = self.calc_price(
+            avg_price, ask_prices, self.ask_liquidity, True)
+
+        # Reset orders, sending the cancels and inserts for both sides
+        # to the exchange in a single write
+        self.outbox = bytearray()
+        try:
             self.bid_base = self.reset_orders(
-                self.etf_bids, Side.BUY, self.new_bid_lot, self.new_bid_price)
+                self.etf_bids, self.new_bid_lot, self.new_bid_price, self.bid_base)
             self.ask_base = self.reset_orders(
-                self.etf_asks, Side.SELL, self.new_ask_lot, self.new_ask_price)
-            self.bid_shifted = self.ask_shifted = None
-
-            # Log inputs
-            with open("output/inputs.csv", "a", newline='') as f:  # DELETEME
-                writer = csv.writer(f)
-                writer.writerow([self.etf_position, self.futures_position, avg_price, self.market_state, self.bid_liquidity,
-                                bid_spread, self.new_bid_lot, self.ask_liquidity, ask_spread, self.new_ask_lot])
-
-    def reset_orders(self, order_set, side, lot, price):
+                self.etf_asks, -self.new_ask_lot, self.new_ask_price, self.ask_base)
+        finally:
+            self.send_batch()
+        self.bid_shifted = self.ask_shifted = None
+
+        # Log inputs
+        if self.debug:
+            self.inputs_file.write(INPUTS_ROW % (self.etf_position, self.futures_position, avg_price,  # DELETEME
+                                                 self.market_state, self.bid_liquidity, bid_spread,
+                                                 self.new_bid_lot, self.ask_liquidity, ask_spread, self.new_ask_lot))
+
+    def reset_orders(self, order_set: Set[int], signed_lot: int, price: int,
+                     base: Optional[Order] = None) -> Optional[Order]:
         """Replace all orders in the order set with new orders.
         
-        Order parameters should be calculated beforehand."""
-        base = None
-
+        Order parameters should be calculated beforehand; the lot is positive
+        for bids and negative for asks. If the current base order is still
+        live at the same price it is left in place rather than being
+        cancelled and inserted again, and amended down if the new lot is
+        smaller."""
+        lot = signed_lot if signed_lot > 0 else -signed_lot
+        insert = lot and price and -POSITION_LIMIT < self.etf_position + signed_lot < POSITION_LIMIT
+        if (not insert or base is None or base.price != price or base.lot < lot
+                or base.id not in order_set or base.id in self.cancelled_ids):
+            base = None
+        elif base.lot > lot:
+            # Amended volumes include the lots already filled
+            self.send_amend_order(base.id, base.filled + lot)
+            base.lot = lot
+        keep_id = base.id if base else None
+
+        # Orders stay in the order set until the exchange confirms they are
+        # gone, so skip the ones we have already asked it to cancel
         for order_id in order_set:
-            self.send_cancel_order(order_id)
+            if order_id != keep_id and order_id not in self.cancelled_ids:
+                self.send_cancel_order(order_id)
+                self.cancelled_ids.add(order_id)
 
-        if lot and price and abs(self.etf_position + (lot if side == Side.BUY else -lot)) < POSITION_LIMIT:
-            base = Order(next(self.order_ids), price, lot, 0)
-            self.send_insert_order(
-                base.id, side, base.price, base.lot, Lifespan.GOOD_FOR_DAY)
-            order_set[base.id] = base
+        if insert and base is None:
+            base = Order(self.next_order_id(), price, lot, 0)
+            self.send_insert_order(base.id, Side.BUY if signed_lot > 0 else Side.SELL,
+                                   base.price, base.lot, Lifespan.GOOD_FOR_DAY)
+            order_set.add(base.id)
 
         return base
 
-    def calc_price(self, avg_price, prices: List[int], liquidity, is_ask=False) -> None:
+    def calc_price(self, avg_price: float, prices: List[int], liquidity: float,
+                   is_ask: bool = False) -> Tuple[int, int]:
         """Calculates price based on liquidity and position.
         We calculate the prices of the bid and ask orders separately based
         on the liquidity of each side of the market and the position of the
         trader.
         """
 
-        spread = 3
-
-        for threshold in LIQUIDITY_THRESHOLDS:
-            if liquidity > threshold:
-                spread -= 1
-
-        adj = -4
-
-        for threshold in POSITION_THRESHOLDS:
-            if self.etf_position > threshold:
-                adj += 1
-
-        if is_ask:
-            adj = -adj
-        emergency_adj = 0
-
-        if adj == -4:
-            emergency_adj = 3
-        elif adj == 4:
-            emergency_adj = -3
-
-        if is_ask:
-            emergency_adj = -emergency_adj
+        # bisect_left counts the (sorted) thresholds strictly below the value
+        spread = 3 - _bisect_left(LIQUIDITY_THRESHOLDS, liquidity)
+        sign = -1 if is_ask else 1
+        adj = sign * (_bisect_left(POSITION_THRESHOLDS, self.etf_position) - 4)
+        emergency_adj = sign * EMERGENCY_ADJUSTMENTS.get(adj, 0)
 
         spread += adj
-        spread = min(4, max(0, spread))
+        if spread < 0:
+            spread = 0
+        elif spread > 4:
+            spread = 4
 
-        return prices[spread] + emergency_adj*TICK_SIZE_IN_CENTS if prices[spread] != 0 else 0, spread
+        price = prices[spread]
+        return price + emergency_adj if price else 0, spread
 
-    def calc_lot_sizes(self, avg_price, ask_prices: List[int], ask_volumes: List[int], bid_prices: List[int],
+    def calc_lot_sizes(self, avg_price: float, ask_prices: List[int], ask_volumes: List[int], bid_prices: List[int],
                        bid_volumes: List[int]) -> None:
         """Calculates lot sizes based on liquidity and position.
         We consider the liquidity of the bid and ask prices separately based
@@ -236,52 +321,52 @@ class AutoTrader(BaseAutoTrader):
         and the prices traded at for bids and asks.
         """
         if ask_prices[0] != 0 and bid_prices[0] != 0:
+            # The liquidities only depend on the book (the average price comes
+            # from its best levels), so keep them while the book is unchanged
+            book = (ask_prices, ask_volumes, bid_prices, bid_volumes)
+            if book != self.last_book:
+                self.last_book = book
+                self.bid_liquidity = self.calc_liquidity(
+                    avg_price, bid_prices, bid_volumes)
+                self.ask_liquidity = self.calc_liquidity(
+                    avg_price, ask_prices, ask_volumes)
 
-            self.bid_liquidity = self.calc_liquidity(
-                avg_price, bid_prices, bid_volumes)
             self.new_bid_lot = self.calc_lot_size(self.bid_liquidity)
-
-            self.ask_liquidity = self.calc_liquidity(
-                avg_price, ask_prices, ask_volumes)
             self.new_ask_lot = self.calc_lot_size(
                 self.ask_liquidity, is_ask=True)
 
-    def calc_liquidity(self, avg_price: int, prices: List[int], volumes: List[int]):
+    def calc_liquidity(self, avg_price: float, prices: List[int], volumes: List[int]) -> float:
         """Calculates liquidity of the market for bids and asks.
+        The distance of each price level from the average price is
+        |log(price / avg_price)|, which needs one log per level and nothing
+        per side.
         TODO: Calculate the average price based on the entire distribution of
         bids and asks rather than just the best bid and ask.
         """
-        distances = [0, 0, 0, 0, 0]
-        for i in range(len(prices)):
-            if prices[i] != 0:
-                distances[i] = 1 / \
-                    abs(math.log(prices[i]) - math.log(avg_price))
-            else:
-                distances[i] = 0
-            weights = [distances[i] * volumes[i] for i in range(len(volumes))]
-            liquidity = sum(weights)
+        liquidity = 0
+        # Empty levels are padded with zeros at the end of the book
+        for price, volume in zip(prices, volumes):
+            if not price:
+                break
+            liquidity += volume / _fabs(_log(price / avg_price))
         return liquidity
 
-    def calc_lot_size(self, liquidity: int, is_ask=False):
+    def calc_lot_size(self, liquidity: float, is_ask: bool = False) -> int:
         """Calculates the lot size for bids and asks.
         Calculates the lot size based on the liquidity of the market and the
         position of the trader. The lot size is proportional to the
         liquidity of the market and inversely proportional to the position 
         of the trader.
         """
-        max_l = 2 * 10 ** 7
-        liquidity = min(liquidity, max_l)
-
         position = -1*self.etf_position if is_ask else self.etf_position
-        p = math.sqrt(1 - (position+100)/200)
-        l = math.sqrt(1 - (max_l-liquidity)/max_l)
 
         # if liquidity > LIQUIDITY_THRESHOLD:
         #     return 15
         # else:
         #     return 5
 
-        return math.floor(20 * p * l)
+        # Liquidity above MAX_LIQUIDITY passes every threshold, so needs no cap
+        return _bisect_right(_LOT_THRESHOLDS[position + POSITION_LIMIT], liquidity)
 
     def on_order_filled_message(self, client_order_id: int, price: int, volume: int) -> None:
         """Called when one of your orders is filled, partially or fully.
@@ -297,12 +382,15 @@ class AutoTrader(BaseAutoTrader):
         if client_order_id in self.etf_bids:
             self.etf_position += volume
             self.position += volume
+            # Track what is left of the base so reset_orders can tell if it has changed
+            if self.bid_base and client_order_id == self.bid_base.id:
+                self.bid_base.lot -= volume
+                self.bid_base.filled += volume
 
             # if abs(self.etf_position) > 30:
-            order = Order(next(self.order_ids),
-                          MAX_ASK_NEAREST_TICK, volume, 0)
-            self.send_hedge_order(order.id, Side.BID, order.price, order.lot)
-            self.futures_bids[order.id] = order
+            order_id = self.next_order_id()
+            self.send_hedge_order(order_id, Side.BID, MAX_ASK_NEAREST_TICK, volume)
+            self.futures_bids.add(order_id)
             # else:
             #     side = Side.ASK if self.position > 0 else Side.BID
             #     price = MIN_BID_NEAREST_TICK if self.position > 0 else MAX_ASK_NEAREST_TICK
@@ -310,24 +398,26 @@ class AutoTrader(BaseAutoTrader):
 
             #     lot_size = abs(self.position)
 
-            #     order = Order(next(self.order_ids), price, lot_size, 0)
+            #     order = Order(self.next_order_id(), price, lot_size, 0)
             #     self.send_hedge_order(order.id, side, order.price, order.lot)
             #     order_set[order.id] = order
 
             if self.etf_position > 20:
-                self.shifted_ask = self.insert_shifted_order(
+                self.ask_shifted = self.insert_shifted_order(
                     self.ask_base, self.ask_shifted, self.etf_asks, Side.SELL, volume//2)
 
         # they are lifting our asks
         elif client_order_id in self.etf_asks:
             self.etf_position -= volume
             self.position -= volume
+            if self.ask_base and client_order_id == self.ask_base.id:
+                self.ask_base.lot -= volume
+                self.ask_base.filled += volume
 
             # if abs(self.position) > 30:
-            order = Order(next(self.order_ids),
-                          MIN_BID_NEAREST_TICK, volume, 0)
-            self.send_hedge_order(order.id, Side.ASK, order.price, order.lot)
-            self.futures_asks[order.id] = order
+            order_id = self.next_order_id()
+            self.send_hedge_order(order_id, Side.ASK, MIN_BID_NEAREST_TICK, volume)
+            self.futures_asks.add(order_id)
             # else:
             #     side = Side.ASK if self.position > 0 else Side.BID
             #     price = MIN_BID_NEAREST_TICK if self.position > 0 else MAX_ASK_NEAREST_TICK
@@ -335,12 +425,12 @@ class AutoTrader(BaseAutoTrader):
 
             #     lot_size = abs(self.position)
 
-            #     order = Order(next(self.order_ids), price, lot_size, 0)
+            #     order = Order(self.next_order_id(), price, lot_size, 0)
             #     self.send_hedge_order(order.id, side, order.price, order.lot)
             #     order_set[order.id] = order
 
             if self.etf_position < -20:
-                self.shifted_bid = self.insert_shifted_order(
+                self.bid_shifted = self.insert_shifted_order(
                     self.bid_base, self.bid_shifted, self.etf_bids, Side.BUY, volume//2)
 
         # if abs(self.etf_position) > 30:
@@ -348,35 +438,35 @@ class AutoTrader(BaseAutoTrader):
         #     price = MAX_ASK_NEAREST_TICK if self.etf_position > 0 else MIN_BID_NEAREST_TICK
         #     oder_set = self.futures_bids if self.etf_position > 0 else self.futures_asks
         #     lot_size = self.etf_position - self.futures_position if self.etf_position > 0 else None
-        #     order = Order(next(self.order_ids), price, lot_size, 0)
+        #     order = Order(self.next_order_id(), price, lot_size, 0)
         #     self.send_hedge_order(order.id, side, order.price, order.lot)
         #     order_set[order.id] = order
 
-    def insert_shifted_order(self, base, shifted, order_set, side, volume):
+    def insert_shifted_order(self, base: Optional[Order], shifted: Optional[Order], order_set: Set[int],
+                             side: Side, volume: int) -> Optional[Order]:
         """Inserts a shifted order at a more competitive price to combat position drift.
         
         If there is already a shifted order, we insert a new shifted order
         below it and reassign shifted to the new order. If there is no shifted
-        order, we insert a new shifted order below the base order."""
+        order, we insert a new shifted order below the base order. Without
+        either there is nothing to shift from, so no order is inserted."""
+        delta = TICK_SIZE_IN_CENTS if side == Side.BUY else -TICK_SIZE_IN_CENTS
         if shifted:
-            shifted.id = next(self.order_ids)
-            shifted.price += TICK_SIZE_IN_CENTS if side == Side.BUY else - \
-                (TICK_SIZE_IN_CENTS)
+            shifted.id = self.next_order_id()
+            shifted.price += delta
             shifted.lot = volume
-            self.send_insert_order(
-                shifted.id, side, shifted.price, shifted.lot, Lifespan.GOOD_FOR_DAY)
+        elif base:
+            shifted = Order(self.next_order_id(), base.price + delta, volume, 0)
         else:
-            price = base.price + TICK_SIZE_IN_CENTS if side == Side.BUY else base.price - \
-                TICK_SIZE_IN_CENTS
-            shifted = Order(next(self.order_ids), price, volume, 0)
-            self.send_insert_order(
-                shifted.id, side, shifted.price, shifted.lot, Lifespan.GOOD_FOR_DAY)
+            return None
 
-        order_set[shifted.id] = shifted
+        self.send_insert_order(
+            shifted.id, side, shifted.price, shifted.lot, Lifespan.GOOD_FOR_DAY)
+        order_set.add(shifted.id)
 
         return shifted
 
-    def emergency_hedge(self):
+    def emergency_hedge(self) -> None:
         """Called to hedge all unhedged lots in emergencies"""
         self.log("")
         self.log("Emergency hedging...")
@@ -391,12 +481,11 @@ class AutoTrader(BaseAutoTrader):
         lot_size = self.position - \
             10 if self.position > 0 else abs(10 + self.position)
 
-        order = Order(next(self.order_ids), price, lot_size, 0)
-        self.send_hedge_order(order.id, side, order.price, order.lot)
-        order_set[order.id] = order
+        order_id = self.next_order_id()
+        self.send_hedge_order(order_id, side, price, lot_size)
+        order_set.add(order_id)
 
-        self.log(
-            f"Emergency hedging {order.lot} lots at {order.price} on side {side}")
+        self.log("Emergency hedging %d lots at %d on side %s", lot_size, price, side)
         self.log("")
 
     def on_hedge_filled_message(self, client_order_id: int, price: int, volume: int) -> None:
@@ -411,37 +500,31 @@ class AutoTrader(BaseAutoTrader):
         if client_order_id in self.futures_bids:
             self.futures_position += volume
             self.position += volume
-            del self.futures_bids[client_order_id]
+            self.futures_bids.discard(client_order_id)
             # Unhedge
             if self.is_hedging:
                 self.log("")
                 self.log("Emergency unhedging...")
-                order = Order(next(self.order_ids),
-                              MIN_BID_NEAREST_TICK, volume, 0)
-                self.log(
-                    f"Emergency unhedging {order.lot} lots at {order.price} on side {Side.ASK}")
+                order_id = self.next_order_id()
+                self.log("Emergency unhedging %d lots at %d on side %s", volume, MIN_BID_NEAREST_TICK, Side.ASK)
                 self.log("")
-                self.send_hedge_order(order.id, Side.ASK,
-                                      order.price, order.lot)
-                self.futures_asks[order.id] = order
+                self.send_hedge_order(order_id, Side.ASK, MIN_BID_NEAREST_TICK, volume)
+                self.futures_asks.add(order_id)
                 self.is_hedging = False
 
         elif client_order_id in self.futures_asks:
             self.futures_position -= volume
             self.position -= volume
-            del self.futures_asks[client_order_id]
+            self.futures_asks.discard(client_order_id)
             # Unhedge
             if self.is_hedging:
                 self.log("")
                 self.log("Emergency unhedging...")
-                order = Order(next(self.order_ids),
-                              MAX_ASK_NEAREST_TICK, volume, 0)
-                self.log(
-                    f"Emergency unhedging {order.lot} lots at {order.price} on side {Side.BID}")
+                order_id = self.next_order_id()
+                self.log("Emergency unhedging %d lots at %d on side %s", volume, MAX_ASK_NEAREST_TICK, Side.BID)
                 self.log("")
-                self.send_hedge_order(order.id, Side.BID,
-                                      order.price, order.lot)
-                self.futures_bids[order.id] = order
+                self.send_hedge_order(order_id, Side.BID, MAX_ASK_NEAREST_TICK, volume)
+                self.futures_bids.add(order_id)
                 self.is_hedging = False
 
     def on_order_status_message(self, client_order_id: int, fill_volume: int, remaining_volume: int,
@@ -459,10 +542,10 @@ class AutoTrader(BaseAutoTrader):
                          client_order_id, fill_volume, remaining_volume, fees)
 
         if remaining_volume == 0:
-            if client_order_id in self.etf_bids:
-                del self.etf_bids[client_order_id]
-            elif client_order_id in self.etf_asks:
-                del self.etf_asks[client_order_id]
+            self.cancelled_ids.discard(client_order_id)
+            # It could be either a bid or an ask
+            self.etf_bids.discard(client_order_id)
+            self.etf_asks.discard(client_order_id)
 
     def on_trade_ticks_message(self, instrument: int, sequence_number: int, ask_prices: List[int],
                                ask_volumes: List[int], bid_prices: List[int], bid_volumes: List[int]) -> None:
@@ -473,5 +556,5 @@ class AutoTrader(BaseAutoTrader):
         If there are less than five prices on a side, then zeros will appear at
         the end of both the prices and volumes arrays.
         """
-        self.logger.info("received trade ticks for instrument %d with sequence number %d", instrument,
-                         sequence_number)
+        self.logger.debug("received trade ticks for instrument %d with sequence number %d", instrument,
+                          sequence_number)